@@ -1,16 +1,57 @@
+import atexit
 import sys
 import os
+import hmac
+import logging
+import threading
+import orjson
 
 # Add the 'src' directory to the Python path
 sys.path.insert(0, 'src')
 
-from flask import Flask, request, jsonify
-from src.main import get_chatbot_response, initialize_clients
+# Under `gunicorn -k gevent` (see Procfile) the standard library is monkey-patched
+# before this module is imported. gRPC, used by Firestore, needs its own hook
+# so its calls yield to other requests instead of blocking the worker.
+from gevent import monkey
+if monkey.is_module_patched('socket'):
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from src.main import (flush_pending_writes, get_chatbot_response, initialize_clients, stream_chatbot_response,
+                      warmup_clients)
+import firebase_client
+
+class OrjsonProvider(JSONProvider):
+    """
+    Serializes Flask JSON (jsonify, request.get_json) with orjson, which is much
+    faster than the stdlib encoder on long, unicode-heavy LLM replies.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # Hand Werkzeug the encoded bytes directly so Content-Length is set up front.
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
+
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper())
+log = logging.getLogger(__name__)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# Initialize Firebase and Gemini clients
-initialize_clients()
+# Initialize Firebase and Gemini clients (one set per worker process)
+clients = initialize_clients(warmup=False)
+# Warm the connections in the background so startup isn't delayed by it.
+threading.Thread(target=warmup_clients, args=(clients,), daemon=True).start()
+# Pending approvals are written in the background; let them finish when gunicorn stops
+# or recycles the worker. Bounded so a hung write can't outlast the graceful timeout.
+atexit.register(flush_pending_writes, timeout=float(os.environ.get('PENDING_WRITES_FLUSH_TIMEOUT', '10')))
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -25,16 +66,13 @@ def chat():
     if not patient_id or not message:
         return jsonify({'error': 'Missing patient_id or message'}), 400
 
-    # --- ADDED FOR DEBUGGING ---
-    # Print the incoming data to the console to verify it's being received correctly.
-    print("-" * 30)
-    print(f"[API Request] Received Patient ID: {patient_id}")
-    print(f"[API Request] Received Message: {message}")
-    print("-" * 30)
-    # ---------------------------
+    # Log the incoming data to verify it's being received correctly.
+    # Only emitted with LOG_LEVEL=DEBUG; the arguments are not formatted otherwise.
+    log.debug("[API Request] Received Patient ID: %s", patient_id)
+    log.debug("[API Request] Received Message: %s", message)
 
     # Get the response from the chatbot logic
-    response_data = get_chatbot_response(patient_id, message)
+    response_data = get_chatbot_response(clients, patient_id, message)
     
     # **SAFEGUARD**: Explicitly convert the response to a string to prevent crashes.
     # The main logic for this is in main.py, but this ensures the API never sends a non-string type.
@@ -42,6 +80,51 @@ def chat():
     
     return jsonify({'response': final_response_text})
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Same request body as /chat, but streams the reply as Server-Sent Events.
+    Each event's data is a JSON object {'chunk': <text>}; the stream ends with a 'done' event.
+    """
+    data = request.get_json()
+    patient_id = data.get('patient_id')
+    message = data.get('message')
+
+    if not patient_id or not message:
+        return jsonify({'error': 'Missing patient_id or message'}), 400
+
+    def generate():
+        for chunk in stream_chatbot_response(clients, patient_id, message):
+            yield f"data: {orjson.dumps({'chunk': chunk}).decode()}\n\n"
+        yield "event: done\ndata: {}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@app.route('/admin/clear-cache', methods=['POST'])
+def clear_cache():
+    """
+    Invalidates the cached specialty -> doctor lookups of the query fallback.
+    While the doctors listener is running, edits to the 'staffs' collection are
+    picked up automatically and there is nothing to clear; this is only needed
+    after a roster change on a worker whose listener has not started.
+    The request must send ADMIN_TOKEN in the 'X-Admin-Token' header; without an
+    ADMIN_TOKEN configured, the endpoint is disabled.
+    """
+    admin_token = os.environ.get('ADMIN_TOKEN')
+    if not admin_token:
+        return jsonify({'error': 'Not found'}), 404
+    sent_token = request.headers.get('X-Admin-Token', '')
+    if not hmac.compare_digest(sent_token.encode(), admin_token.encode()):
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    listener_active = firebase_client.clear_doctor_cache()
+    return jsonify({'status': 'cleared', 'listener_active': listener_active})
+
 if __name__ == '__main__':
+    # Development server only; production runs under gunicorn (see Procfile).
     # Runs the Flask app on your local network
     app.run(host='0.0.0.0', port=5000)
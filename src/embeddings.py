@@ -0,0 +1,142 @@
+import os
+import threading
+import numpy as np
+from cachetools import TTLCache
+from sentence_transformers import SentenceTransformer
+
+# Appointment documents may carry a 'symptomsEmbedding' precomputed with this
+# same model when they are written; anything else is embedded on the fly.
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# "torch" (default), or "onnx"/"openvino" if the matching sentence-transformers extra is
+# installed; EMBEDDING_MODEL_FILE then picks e.g. one of the model's int8 ONNX exports.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_MODEL_FILE = os.getenv("EMBEDDING_MODEL_FILE")
+# With the torch backend, the model's Linear layers are quantized to int8 for faster CPU inference.
+EMBEDDING_QUANTIZE = os.getenv("EMBEDDING_QUANTIZE", "true").lower() == "true"
+# The model is downloaded into the app directory at build time (bin/post_compile runs
+# `python src/embeddings.py`), so workers load it from disk instead of fetching it from the Hub.
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR",
+                                os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models"))
+
+# Stored vectors are kept as int8; a normalized component in [-1, 1] maps to [-127, 127].
+_INT8_SCALE = 127
+
+_model = None
+_model_lock = threading.Lock()
+
+def _get_model():
+    """Loads the sentence embedding model once per process."""
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                print(f"Loading embedding model: {EMBEDDING_MODEL_NAME} ({EMBEDDING_BACKEND})...")
+                model_kwargs = {"file_name": EMBEDDING_MODEL_FILE} if EMBEDDING_MODEL_FILE else None
+                model = SentenceTransformer(EMBEDDING_MODEL_NAME, device="cpu" if EMBEDDING_QUANTIZE else None,
+                                            backend=EMBEDDING_BACKEND, model_kwargs=model_kwargs,
+                                            cache_folder=EMBEDDING_CACHE_DIR)
+                if EMBEDDING_BACKEND == "torch" and EMBEDDING_QUANTIZE:
+                    model = _quantize_torch_model(model)
+                _model = model
+    return _model
+
+def _quantize_torch_model(model):
+    """Applies dynamic int8 quantization to the model's Linear layers; keeps fp32 if that fails."""
+    # torch is pinned in requirements.txt; newer releases deprecate torch.ao.quantization.
+    try:
+        import torch
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    except Exception as e:
+        print(f"Embedding model quantization failed, using fp32: {e}")
+        return model
+
+def embed(texts):
+    """
+    Embeds a list of texts.
+
+    Returns:
+        np.ndarray: float32 array of shape (len(texts), dim) with L2-normalized rows,
+        so a dot product between rows is their cosine similarity.
+    """
+    vectors = _get_model().encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+    return np.asarray(vectors, dtype=np.float32)
+
+def embed_appointments(appointments):
+    """
+    Returns the normalized symptom embeddings for a list of appointments, one row each.
+    Stored 'symptomsEmbedding' values are reused; the rest are embedded in a single batch.
+    """
+    dim = _get_model().get_sentence_embedding_dimension()
+    vectors = np.zeros((len(appointments), dim), dtype=np.float32)
+    missing = []
+    for i, app in enumerate(appointments):
+        stored = app.get('symptomsEmbedding')
+        if stored is not None and len(stored) == dim:
+            vector = np.asarray(stored, dtype=np.float32)
+            norm = np.linalg.norm(vector)
+            if norm > 0:
+                vectors[i] = vector / norm
+                continue
+        missing.append(i)
+    if missing:
+        vectors[missing] = embed([appointments[i].get('symptomsText', '') for i in missing])
+    return vectors
+
+def quantize(vectors):
+    """Stores normalized float vectors as int8, a quarter of their float32 size."""
+    return np.clip(np.rint(vectors * _INT8_SCALE), -_INT8_SCALE, _INT8_SCALE).astype(np.int8)
+
+def similarities(quantized, query):
+    """Cosine similarities between int8 rows from quantize() and a normalized float query."""
+    return (quantized.astype(np.int32) @ quantize(query).astype(np.int32)) / (_INT8_SCALE * _INT8_SCALE)
+
+class SemanticCache:
+    """
+    Caches values by the meaning of a text: a lookup hits when a stored text's
+    embedding has cosine similarity >= threshold with the query's embedding.
+    Entries are grouped by namespace (e.g. task name plus any non-text inputs),
+    and each namespace keeps its most recent `max_entries` entries.
+    """
+    def __init__(self, threshold=0.92, max_entries=256, max_namespaces=1024, ttl=3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._namespaces = TTLCache(maxsize=max_namespaces, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, namespace, vector):
+        """Returns the cached value closest to `vector` in `namespace`, or None on a miss."""
+        with self._lock:
+            entries = self._namespaces.get(namespace)
+            if not entries:
+                return None
+            vectors, values = entries
+            scores = similarities(vectors, vector)
+            best = int(np.argmax(scores))
+            return values[best] if scores[best] >= self.threshold else None
+
+    def put(self, namespace, vector, value):
+        """Stores `value` under `vector` in `namespace`, evicting the oldest entry when full."""
+        with self._lock:
+            vectors, values = self._namespaces.get(namespace, (np.empty((0, len(vector)), dtype=np.int8), []))
+            vectors = np.vstack([vectors, quantize(vector)[None, :]])[-self.max_entries:]
+            values = (values + [value])[-self.max_entries:]
+            self._namespaces[namespace] = (vectors, values)
+
+    def get_or_call(self, namespace, text, func, vector=None):
+        """
+        Returns the cached value for a text similar to `text`, or calls func() and caches its result.
+        `vector` is the text's embedding, if the caller already has it.
+        """
+        if vector is None:
+            vector = embed([text])[0]
+        value = self.get(namespace, vector)
+        if value is None:
+            value = func()
+            if value is not None:
+                self.put(namespace, vector, value)
+        return value
+
+if __name__ == "__main__":
+    # Build step, run by bin/post_compile after the requirements are installed.
+    _get_model()
+    print(f"Embedding model cached in {EMBEDDING_CACHE_DIR}")
@@ -1,17 +1,57 @@
 import os
+import itertools
 import firebase_admin
 from firebase_admin import credentials, firestore
-import pandas as pd
+from cachetools import TTLCache
 
 # Global variable for the database client
 db = None
 
+# Read paths round-robin over several Firestore clients (each with its own gRPC
+# channel) so concurrent requests don't queue on a single channel.
+FIRESTORE_POOL_SIZE = int(os.environ.get('FIRESTORE_POOL_SIZE', '4'))
+_read_pool = None
+
+# Appointment fields the chatbot actually uses; everything else stays on the server.
+APPOINTMENT_FIELDS = ['appointmentDate', 'symptomsText', 'symptomsEmbedding', 'patientName', 'prescriptions', 'staffId']
+MAX_APPOINTMENTS = 20
+# Each 'patients/{patientId}' document can carry a copy of the patient's newest
+# MAX_APPOINTMENTS appointments in 'recent_appointments' (newest first), so a session
+# reads one document instead of querying 'appointments'. The 'appointments' query
+# stays the source of truth until every appointment writer calls
+# record_recent_appointment(); only then set USE_RECENT_APPOINTMENTS=true.
+USE_RECENT_APPOINTMENTS = os.environ.get('USE_RECENT_APPOINTMENTS', 'false').lower() == 'true'
+
+# Specialty -> (doctor_id, doctor_name) lookups for the query fallback only, i.e.
+# before the doctors listener's first snapshot or when it could not be started.
+# Once the listener is running, roster changes reach _doctors_by_specialty on their own.
+_doctor_cache = TTLCache(maxsize=64, ttl=300)
+# Specialties with no matching doctor, kept for a shorter time so a newly added
+# doctor is picked up quickly.
+_doctor_miss_cache = TTLCache(maxsize=64, ttl=60)
+
+# specialty (lowercase) -> (doctor_id, doctor_name), kept in sync with the 'staffs'
+# collection by a snapshot listener. None until the first snapshot arrives, in which
+# case find_doctor_by_specialty falls back to querying Firestore.
+_doctors_by_specialty = None
+# staffs document ID -> doctor name, maintained by the same listener.
+_doctor_names_by_id = {}
+_doctors_watch = None
+
 def initialize_firebase():
     """
     Initializes the Firebase client.
     This new method is more robust and works both on Render and locally.
     """
-    global db
+    global db, _read_pool, _doctors_watch
+    # initialize_app() raises if the default app already exists, which used to send a
+    # second call (e.g. from the CLI and the API in one process) down the fallback path.
+    if firebase_admin._apps:
+        print("Firebase is already initialized. Reusing the existing app.")
+        if db is None:
+            db = firestore.client()
+        return
+
     try:
         # Naya, behtar tareeka:
         # Yeh line automatically Render par 'google_credentials.json' dhoondh legi.
@@ -20,9 +60,10 @@ def initialize_firebase():
         print("Initializing Firebase using Application Default Credentials (for Render)...")
         # Project ID environment variable se aayega
         project_id = os.environ.get('FIREBASE_PROJECT_ID')
-        firebase_admin.initialize_app(cred, {
+        options = {
             'projectId': project_id, 
-        })
+        }
+        firebase_admin.initialize_app(cred, options)
         
     except Exception as e:
         print(f"Could not use Application Default Credentials ({e}). Falling back to local key file...")
@@ -30,6 +71,7 @@ def initialize_firebase():
             # Local computer ke liye fallback
             local_path = 'serviceAccountKey.json'
             cred = credentials.Certificate(local_path)
+            options = None
             firebase_admin.initialize_app(cred)
             print(f"Initializing Firebase from local file: {local_path}...")
         except Exception as local_e:
@@ -37,65 +79,295 @@ def initialize_firebase():
             raise local_e
 
     db = firestore.client()
-    print("Firebase initialized successfully.")
+    pool = [db]
+    for i in range(1, FIRESTORE_POOL_SIZE):
+        pool_app = firebase_admin.initialize_app(cred, options, name=f'firestore-pool-{i}')
+        pool.append(firestore.client(pool_app))
+    _read_pool = itertools.cycle(pool)
+    print(f"Firebase initialized successfully ({len(pool)} Firestore client(s) for reads).")
+
+    try:
+        _doctors_watch = db.collection('staffs').where('role', '==', 'Doctor').on_snapshot(_on_doctors_snapshot)
+    except Exception as e:
+        print(f"Could not start the doctors listener ({e}). Doctor lookups will query Firestore.")
 
+def _on_doctors_snapshot(doc_snapshots, changes, read_time):
+    """Rebuilds the in-memory doctor indexes whenever the doctor roster changes."""
+    global _doctors_by_specialty, _doctor_names_by_id
+    index = {}
+    names = {}
+    for doc in doc_snapshots:
+        doctor = doc.to_dict()
+        if doctor.get('name'):
+            names[doc.id] = doctor['name']
+        specialization = doctor.get('specialization')
+        if specialization:
+            # Keep the first doctor per specialty, like the query path does.
+            index.setdefault(specialization.lower(), (doctor.get('staffId'), doctor.get('name')))
+    _doctor_names_by_id = names
+    _doctors_by_specialty = index
+    print(f"Doctor index updated: {len(index)} specialties.")
 
-def get_patient_appointments_by_id(patient_id):
-    """Fetches all appointments for a given patient ID."""
+def _read_db():
+    """Returns the next Firestore client from the read pool."""
+    return next(_read_pool) if _read_pool else db
+
+
+def warmup():
+    """Issues a trivial read on every pooled client so their gRPC channels are connected."""
+    if not db: return
+    for _ in range(FIRESTORE_POOL_SIZE if _read_pool else 1):
+        _read_db().collection('staffs').limit(1).get()
+
+def get_patient_appointments_by_id(patient_id, full_history=False):
+    """
+    Fetches the most recent appointments (newest first) for a given patient ID.
+    With USE_RECENT_APPOINTMENTS they are read from the patient's denormalized
+    'recent_appointments' when it exists; otherwise, or with full_history=True,
+    'appointments' is queried.
+    The query orders by 'appointmentDate', and Firestore leaves out documents
+    without the ordered field, so undated appointments are never returned
+    (count_undated_appointments() finds them).
+    """
     if not db: return []
-    appointments_ref = db.collection('appointments').where('patientId', '==', patient_id).stream()
-    return [appointment.to_dict() for appointment in appointments_ref]
+    if USE_RECENT_APPOINTMENTS and not full_history:
+        recent = _get_recent_appointments(patient_id)
+        if recent is not None:
+            return recent
+    appointments_ref = (_read_db().collection('appointments')
+                        .where('patientId', '==', patient_id)
+                        .order_by('appointmentDate', direction=firestore.Query.DESCENDING)
+                        .limit(MAX_APPOINTMENTS)
+                        .select(APPOINTMENT_FIELDS)
+                        .stream())
+    return [{**appointment.to_dict(), 'doc_id': appointment.id} for appointment in appointments_ref]
 
-def get_doctor_name(staff_id):
-    """Fetches a doctor's name using their staff ID."""
-    if not db: return "a doctor"
+def count_undated_appointments():
+    """
+    Data check: counts the 'appointments' documents without an 'appointmentDate'.
+    get_patient_appointments_by_id skips these, so it should return 0.
+    """
+    if not db: return 0
+    missing = sum(1 for doc in db.collection('appointments').select(['appointmentDate']).stream()
+                  if 'appointmentDate' not in (doc.to_dict() or {}))
+    print(f"{missing} appointment(s) without an 'appointmentDate'.")
+    return missing
+
+def _get_recent_appointments(patient_id):
+    """Returns the patient's denormalized recent appointments, or None if they aren't stored."""
     try:
-        doc_ref = db.collection('staffs').document(staff_id).get()
-        if doc_ref.exists:
-            return doc_ref.to_dict().get('name', "a doctor")
+        doc = _read_db().collection('patients').document(patient_id).get(field_paths=['recent_appointments'])
+        recent = doc.to_dict().get('recent_appointments') if doc.exists else None
     except Exception as e:
-        print(f"Error fetching doctor name: {e}")
-    return "a doctor"
+        print(f"Error reading recent appointments: {e}")
+        return None
+    if recent is None:
+        return None
+    return [{**{k: v for k, v in entry.items() if k != 'appointmentId'}, 'doc_id': entry.get('appointmentId')}
+            for entry in recent]
+
+def _recent_appointment_entry(appointment_id, appointment):
+    """The copy of an appointment kept in 'recent_appointments' (only APPOINTMENT_FIELDS)."""
+    entry = {field: appointment[field] for field in APPOINTMENT_FIELDS if field in appointment}
+    entry['appointmentId'] = appointment_id
+    return entry
+
+def _newest_first(entries):
+    """Sorts recent-appointment entries newest first and caps them at MAX_APPOINTMENTS."""
+    entries = sorted(entries, key=lambda entry: str(entry.get('appointmentDate') or ''), reverse=True)
+    return entries[:MAX_APPOINTMENTS]
+
+def record_recent_appointment(patient_id, appointment_id, appointment):
+    """
+    Adds (or refreshes) an appointment in the patient's 'recent_appointments'.
+    Whatever writes to 'appointments' should call this (or do the same from a
+    Cloud Function) so the denormalized copy stays current.
+    """
+    if not db: return False
+    patient_ref = db.collection('patients').document(patient_id)
+
+    @firestore.transactional
+    def update(transaction):
+        snapshot = patient_ref.get(field_paths=['recent_appointments'], transaction=transaction)
+        recent = (snapshot.to_dict() or {}).get('recent_appointments', []) if snapshot.exists else []
+        recent = [entry for entry in recent if entry.get('appointmentId') != appointment_id]
+        recent.append(_recent_appointment_entry(appointment_id, appointment))
+        transaction.set(patient_ref, {'recent_appointments': _newest_first(recent)}, merge=True)
+
+    try:
+        update(db.transaction())
+        return True
+    except Exception as e:
+        print(f"Error recording recent appointment: {e}")
+        return False
+
+def backfill_recent_appointments():
+    """
+    One-time migration: builds 'recent_appointments' on every patient document
+    from the 'appointments' collection. Run it again right before turning on
+    USE_RECENT_APPOINTMENTS, once the appointment writers keep the field current.
+    """
+    if not db: return 0
+    by_patient = {}
+    for doc in db.collection('appointments').select(APPOINTMENT_FIELDS + ['patientId']).stream():
+        appointment = doc.to_dict()
+        patient_id = appointment.get('patientId')
+        if patient_id:
+            by_patient.setdefault(patient_id, []).append(_recent_appointment_entry(doc.id, appointment))
+
+    batch = db.batch()
+    pending, updated = 0, 0
+    for patient_id, entries in by_patient.items():
+        batch.set(db.collection('patients').document(patient_id),
+                  {'recent_appointments': _newest_first(entries)}, merge=True)
+        pending += 1
+        if pending == 500:  # Firestore's per-batch write limit
+            batch.commit()
+            updated += pending
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        updated += pending
+    print(f"Backfilled 'recent_appointments' on {updated} patient(s).")
+    return updated
+
+def get_doctor_names(staff_ids):
+    """
+    Fetches the names of several staff members.
+    Doctors known to the roster listener are answered from memory; the rest are
+    fetched together in a single batched read.
+    Returns a dict of staff ID -> name; unknown IDs map to "a doctor".
+    """
+    names = {staff_id: "a doctor" for staff_id in staff_ids if staff_id}
+    known = _doctor_names_by_id
+    missing = []
+    for staff_id in names:
+        if staff_id in known:
+            names[staff_id] = known[staff_id]
+        else:
+            missing.append(staff_id)
+    if not db or not missing: return names
+    try:
+        client = _read_db()
+        refs = [client.collection('staffs').document(staff_id) for staff_id in missing]
+        for doc in client.get_all(refs):
+            if doc.exists:
+                names[doc.id] = doc.to_dict().get('name', "a doctor")
+    except Exception as e:
+        print(f"Error fetching doctor names: {e}")
+    return names
+
+def get_doctor_name(staff_id):
+    """Fetches a doctor's name using their staff ID."""
+    return get_doctor_names([staff_id]).get(staff_id, "a doctor")
 
 def find_doctor_by_specialty(specialty):
     """Finds an available doctor matching a given specialty."""
     if not db or not specialty: return None, None
+    key = specialty.lower()
+    if _doctors_by_specialty is not None:
+        return _doctors_by_specialty.get(key, (None, None))
+    if key in _doctor_cache:
+        return _doctor_cache[key]
+    if key in _doctor_miss_cache:
+        return None, None
     try:
-        staffs_ref = db.collection('staffs').where('role', '==', 'Doctor').stream()
-        doctors_list = [doc.to_dict() for doc in staffs_ref]
-        if not doctors_list:
-            print("No doctors found in 'staffs' collection.")
-            return None, None
-        doctors_df = pd.DataFrame(doctors_list)
-        matching_doctors = doctors_df[doctors_df['specialization'].str.lower() == specialty.lower()]
-        if not matching_doctors.empty:
-            doctor = matching_doctors.iloc[0]
+        # Filtering happens server-side on the normalized 'specialization_lc' field
+        # (see backfill_specialization_lc and firestore.indexes.json).
+        staffs_ref = (_read_db().collection('staffs')
+                      .where('role', '==', 'Doctor')
+                      .where('specialization_lc', '==', key)
+                      .limit(1)
+                      .stream())
+        doctor = next((doc.to_dict() for doc in staffs_ref), None)
+        if doctor:
             doctor_id = doctor.get('staffId')
             doctor_name = doctor.get('name')
             print(f"Found matching doctor: {doctor_name} for specialty: {specialty}")
+            _doctor_cache[key] = (doctor_id, doctor_name)
             return doctor_id, doctor_name
         else:
             print(f"No doctor found for specialty: {specialty}")
+            _doctor_miss_cache[key] = True
             return None, None
     except Exception as e:
         print(f"An error occurred in find_doctor_by_specialty: {e}")
         return None, None
 
-def create_pending_approval(patient_id, doctor_id, symptoms, ai_output):
-    """Creates a record in the 'pendingApprovals' collection."""
+def backfill_specialization_lc():
+    """
+    One-time migration: stores a lowercased copy of 'specialization' as
+    'specialization_lc' on every doctor, so find_doctor_by_specialty can query it directly.
+    Staff documents written from now on should set 'specialization_lc' as well.
+    """
+    if not db: return 0
+    batch = db.batch()
+    pending, updated = 0, 0
+    for doc in db.collection('staffs').where('role', '==', 'Doctor').stream():
+        specialization = doc.to_dict().get('specialization')
+        if not specialization:
+            continue
+        batch.update(doc.reference, {'specialization_lc': specialization.lower()})
+        pending += 1
+        if pending == 500:  # Firestore's per-batch write limit
+            batch.commit()
+            updated += pending
+            batch, pending = db.batch(), 0
+    if pending:
+        batch.commit()
+        updated += pending
+    print(f"Backfilled 'specialization_lc' on {updated} doctor(s).")
+    return updated
+
+def clear_doctor_cache():
+    """
+    Drops the cached specialty -> doctor lookups of the query fallback.
+    Has no effect on the listener-backed index, which follows the roster by itself.
+    Returns True if the listener index is active.
+    """
+    _doctor_cache.clear()
+    _doctor_miss_cache.clear()
+    return _doctors_by_specialty is not None
+
+def new_batch():
+    """Returns a Firestore WriteBatch for grouping several writes into one commit."""
+    if not db: return None
+    return db.batch()
+
+def commit_batch(batch):
+    """Commits a WriteBatch created by new_batch(). Returns True on success."""
+    if not batch: return False
+    try:
+        batch.commit()
+        return True
+    except Exception as e:
+        print(f"Error committing batched writes: {e}")
+        return False
+
+def create_pending_approval(patient_id, doctor_id, symptoms, ai_output, batch=None):
+    """
+    Creates a record in the 'pendingApprovals' collection.
+    If a WriteBatch is given, the write is only queued on it; the caller
+    must commit the batch.
+    """
     if not db: return None
     try:
-        doc_ref = db.collection('pendingApprovals').add({
+        approval_ref = db.collection('pendingApprovals').document()
+        approval_data = {
             'patientId': patient_id,
             'staffId': doctor_id,
             'symptoms': symptoms,
             'aiOutput': ai_output,
             'status': 'Pending',
             'timestamp': firestore.SERVER_TIMESTAMP
-        })
-        print(f"Successfully created pending approval record: {doc_ref[1].id}")
-        return doc_ref[1].id
+        }
+        if batch is not None:
+            batch.set(approval_ref, approval_data)
+            print(f"Queued pending approval record: {approval_ref.id}")
+        else:
+            approval_ref.set(approval_data)
+            print(f"Successfully created pending approval record: {approval_ref.id}")
+        return approval_ref.id
     except Exception as e:
         print(f"Error creating pending approval: {e}")
         return None
-
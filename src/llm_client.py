@@ -1,38 +1,364 @@
+import atexit
 import os
-import json
+import re
 import time
+import threading
+import unicodedata
+from contextlib import contextmanager
+from dataclasses import dataclass
+import ahocorasick
+import httpx
+import numpy as np
+import orjson
 import google.generativeai as genai
-from openai import OpenAI
+from cachetools import LFUCache
+from openai import OpenAI, RateLimitError
 from dotenv import load_dotenv
 from google.api_core.exceptions import ResourceExhausted
+from tenacity import (Retrying, retry, retry_if_exception, retry_if_exception_type, stop_after_delay,
+                      wait_random_exponential)
+
+import embeddings
+
+# Static task instructions. These are sent as system instructions so each request
+# only carries the dynamic payload (symptoms, appointments, ...). They are well below
+# the 1024-token minimum for provider prompt caching, so nothing is cached for them.
+SPECIALTY_SYSTEM_PROMPT = '''You are a medical expert. Based on the symptoms given by the user, what is the most appropriate medical specialty to consult?
+Choose from common specialties like General Physician, ENT, Dermatologist, Orthopedic, Gynecologist, Cardiologist, etc.
+Return only the name of the specialty.'''
+
+RED_FLAG_SYMPTOMS = """Red flag symptoms include, but are not limited to:
+- Chest pain or pressure
+- Difficulty breathing or shortness of breath
+- Severe headache, especially if sudden
+- Weakness, numbness, or paralysis, especially on one side of the body
+- Confusion or altered mental state
+- Slurred speech
+- Seizures
+- High fever with a stiff neck
+- Severe abdominal pain
+- Uncontrolled bleeding
+- Thoughts of self-harm or suicide
+- Mention of a serious diagnosis like 'cancer', 'heart attack', 'stroke'"""
+
+RED_FLAG_SYSTEM_PROMPT = f'''You are a medical triage expert. Your task is to determine if the user's statement contains any critical, life-threatening symptoms.
+These are considered "red flags".
+
+{RED_FLAG_SYMPTOMS}
+
+Based on the user input, does it contain any red flag symptoms? Answer with only "true" or "false".'''
+
+COMBINED_RESPONSE_SYSTEM_PROMPT = '''You are a helpful medical assistant chatbot.
+You will be given the user's symptoms and the AI's analysis based on their past records.
+
+Your task is to present the AI's analysis to the user in a single, clear message.
+Do not list medicines, mention doctor referrals or add a disclaimer: the past prescription,
+the routing information and the disclaimer are appended after your message.
+
+Generate a short, friendly and reassuring response.'''
+
+# Shared by both single-call prompts, so their triage rules can't drift apart.
+_TRIAGE_PREAMBLE = f'''You are a medical triage expert. Critical, life-threatening symptoms are considered "red flags".
+
+{RED_FLAG_SYMPTOMS}
+
+For each user turn you will be given the patient's new symptoms. Answer these questions at once:
+
+1. "red_flag": does the new input contain any red flag symptoms? (true or false)
+2. "specialty": the most appropriate medical specialty to consult, chosen from common specialties like
+   General Physician, ENT, Dermatologist, Orthopedic, Gynecologist, Cardiologist, etc.'''
+
+TURN_ANALYSIS_SYSTEM_PROMPT = _TRIAGE_PREAMBLE + '''
+
+Respond with only a JSON object of the form:
+{"red_flag": false, "specialty": "General Physician"}'''
+
+TURN_RESPONSE_SYSTEM_PROMPT = _TRIAGE_PREAMBLE + '''
+3. "summary": a short, friendly and reassuring message for the user that presents the AI's analysis
+   based on their past records, which you are also given. Do not list medicines, mention doctor
+   referrals or add a disclaimer: the past prescription, the routing information and the disclaimer
+   are appended after your message.
+
+Respond with only a JSON object of the form:
+{"red_flag": false, "specialty": "General Physician", "summary": "..."}'''
+
+# Reply schemas for analyze_turn, enforced by the provider so the reply always parses.
+TURN_ANALYSIS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "red_flag": {"type": "boolean"},
+        "specialty": {"type": "string"},
+    },
+    "required": ["red_flag", "specialty"],
+}
+TURN_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {**TURN_ANALYSIS_SCHEMA["properties"], "summary": {"type": "string"}},
+    "required": ["red_flag", "specialty", "summary"],
+}
+# OpenAI only enforces schemas (strict structured outputs) on newer models.
+OPENAI_STRUCTURED_MODEL = os.getenv("OPENAI_STRUCTURED_MODEL", "gpt-4o-mini")
+
+def _openai_response_format(name, schema):
+    """Wraps a schema as an OpenAI strict json_schema response format."""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": {**schema, "additionalProperties": False}},
+    }
+
+# Example symptom descriptions per specialty, for classifying symptoms locally
+# (see classify_specialty). Names must match the doctors' 'specialization' values.
+SPECIALTY_PROTOTYPES = {
+    "General Physician": ["fever and body aches", "cold and flu symptoms", "feeling weak and tired all the time",
+                          "mild fever with headache", "general checkup"],
+    "ENT": ["sore throat and difficulty swallowing", "ear pain and ringing in the ears", "blocked nose and sinus pain",
+            "hearing loss", "tonsils are swollen"],
+    "Dermatologist": ["itchy skin rash", "acne and pimples on my face", "hair loss and dandruff",
+                      "red patches and eczema", "skin allergy with hives"],
+    "Orthopedic": ["knee pain when walking", "lower back pain", "joint pain and stiffness",
+                   "shoulder pain after an injury", "sprained ankle"],
+    "Gynecologist": ["irregular periods", "painful menstruation", "pregnancy checkup",
+                     "vaginal discharge and itching", "pelvic pain"],
+    "Cardiologist": ["heart palpitations", "high blood pressure", "irregular heartbeat",
+                     "swelling in my legs and feet", "high cholesterol"],
+    "Gastroenterologist": ["stomach ache and acidity", "diarrhea and vomiting", "constipation and bloating",
+                           "heartburn after eating", "blood in stool"],
+    "Neurologist": ["frequent migraines", "dizziness and vertigo", "numbness and tingling in my hands",
+                    "tremors in my hands", "memory problems"],
+    "Ophthalmologist": ["blurry vision", "red and itchy eyes", "eye pain",
+                        "watery eyes", "difficulty seeing at night"],
+    "Psychiatrist": ["feeling anxious all the time", "feeling depressed and hopeless", "trouble sleeping",
+                     "panic attacks", "mood swings"],
+    "Urologist": ["burning when urinating", "frequent urination", "kidney stone pain",
+                  "blood in urine", "difficulty passing urine"],
+    "Dentist": ["toothache", "bleeding gums", "sensitive teeth", "swollen jaw and tooth pain", "broken tooth"],
+}
+# The local classification is used when its softmax confidence reaches this; otherwise the LLM decides.
+SPECIALTY_MIN_CONFIDENCE = float(os.getenv("SPECIALTY_MIN_CONFIDENCE", "0.6"))
+# Softmax temperature over cosine similarities, which lie close together.
+_SPECIALTY_TEMPERATURE = 0.05
+
+# Minimum cosine similarity between the new symptoms and a past appointment's
+# symptoms for them to count as a match.
+BEST_MATCH_THRESHOLD = float(os.getenv("BEST_MATCH_THRESHOLD", "0.55"))
+# Only the most recent appointments with recorded symptoms are compared.
+MAX_MATCH_CANDIDATES = 20
+
+# Unambiguous red-flag phrases per language, matched locally before any LLM call
+# (see prefilter_red_flags). Users may write in any language, so the common ways of
+# describing emergencies in Roman Urdu, Urdu and Hindi are covered too.
+RED_FLAG_PHRASES = {
+    "en": [
+        "chest pain", "chest pressure", "chest tightness", "pain in my chest", "crushing chest",
+        "chest ache", "chest hurts", "chest is hurting",
+        "difficulty breathing", "shortness of breath", "trouble breathing", "can't breathe", "cannot breathe",
+        "cant breathe", "not breathing", "is choking", "am choking", "blue lips", "lips turning blue",
+        "severe headache", "worst headache", "sudden headache",
+        "paralysis", "paralyzed", "one side of my body", "face drooping", "facial droop",
+        "sudden numbness", "numb on one side", "sudden weakness", "weak on one side", "arm is weak", "arm feels weak", "arm weak",
+        "leg is weak", "leg feels weak", "leg weak", "side is weak", "can't move my arm", "can't move my leg",
+        "sudden confusion", "suddenly confused", "not making sense",
+        "slurred speech", "can't speak", "seizure", "seizures", "convulsion", "convulsions",
+        "stiff neck", "neck stiff", "neck is stiff", "neck very stiff", "neck is very stiff", "neck stiffness",
+        "stiffness in my neck", "severe abdominal pain", "severe stomach pain",
+        "uncontrolled bleeding", "heavy bleeding", "won't stop bleeding", "coughing up blood",
+        "vomiting blood", "blood in vomit",
+        "anaphylaxis", "anaphylactic", "throat closing", "throat is closing", "tongue swelling", "swollen tongue",
+        "overdose", "overdosed", "swallowed poison",
+        "suicide", "suicidal", "kill myself", "self-harm", "self harm", "end my life", "want to die",
+        "cancer", "heart attack", "having a stroke", "unconscious", "passed out", "fainted", "not responding",
+    ],
+    "ur-Latn": [
+        "seene mein dard", "seene me dard", "seenay mein dard", "chhati mein dard", "chati me dard",
+        "saans nahi aa rahi", "saans nahi aa raha", "saans lene mein takleef", "saans lene me mushkil", "saans phool",
+        "dil ka daura", "falij", "lakwa", "behosh", "khoon nahi ruk raha", "khoon ki ulti", "mirgi ka daura",
+        "khudkushi", "khud kushi", "marna chahta", "marna chahti",
+    ],
+    "ur": [
+        "سینے میں درد", "سانس نہیں", "سانس لینے میں", "دل کا دورہ", "فالج", "بے ہوش", "بیہوش",
+        "خون نہیں رک", "خون کی الٹی", "مرگی کا دورہ", "خودکشی", "خود کشی", "کینسر",
+    ],
+    "hi": [
+        "सीने में दर्द", "छाती में दर्द", "सांस नहीं", "साँस नहीं", "सांस लेने में", "दिल का दौरा",
+        "लकवा", "बेहोश", "खून नहीं रुक", "खून की उल्टी", "मिर्गी का दौरा", "आत्महत्या", "कैंसर",
+    ],
+}
+# Words that describe emergencies but are just as common in everyday speech
+# ("confused about my dosage", "toes feel numb in the cold", "a stroke of luck").
+# A hit on one of these is never decided locally; it goes to the LLM.
+RED_FLAG_WEAK_PHRASES = {
+    "en": ["numb", "numbness", "confused", "confusion", "disoriented", "choking", "stroke", "poisoning"],
+}
+# A red-flag phrase preceded by one of these within RED_FLAG_NEGATION_WINDOW words of
+# the same clause ("I have no chest pain") is treated as weak, so the LLM decides.
+RED_FLAG_NEGATIONS = frozenset(
+    "no not without never don't dont doesn't doesnt didn't didnt haven't havent hasn't hasnt "
+    "isn't isnt aren't arent wasn't wasnt denies deny".split()
+)
+RED_FLAG_NEGATION_WINDOW = 3
+
+# Inputs made up only of these words (greetings, thanks, ...) describe no symptoms and
+# skip the LLM red-flag check. Anything else without a red-flag phrase goes to the LLM.
+SMALL_TALK_WORDS = frozenset(
+    "hi hello hey hiya thanks thank you thx ok okay bye goodbye good morning afternoon evening night "
+    "yes no sure great fine please salam salaam assalam assalamu o wa alaikum walaikum aoa shukriya shukria "
+    "theek thik hai acha accha namaste dhanyavad".split()
+)
+
+def _normalize_for_scan(text):
+    """
+    NFKC-normalizes and casefolds text so full-width, ligature and curly-quote variants
+    match, and treats hyphens/underscores like spaces ('chest-pain' -> 'chest pain').
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = text.replace("\u2019", "'").replace("\u2018", "'")
+    return " ".join(re.sub(r"[-_]+", " ", text).split())
+
+_red_flag_automaton = ahocorasick.Automaton()
+for _strong, _table in ((False, RED_FLAG_WEAK_PHRASES), (True, RED_FLAG_PHRASES)):
+    for _language, _phrases in _table.items():
+        for _phrase in _phrases:
+            _phrase = _normalize_for_scan(_phrase)
+            _red_flag_automaton.add_word(_phrase, (_language, _phrase, _strong))
+_red_flag_automaton.make_automaton()
+
+# Response caches. Red-flag answers are safety-critical, so they are only reused for the
+# exact same (whitespace/case-normalized) input; specialties and replies are reused
+# for inputs that mean nearly the same thing.
+_red_flag_cache = LFUCache(maxsize=2048)
+_red_flag_cache_lock = threading.Lock()
+_semantic_cache = embeddings.SemanticCache(threshold=float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92")))
+
+def _normalize_input(text):
+    """Lowercases and collapses whitespace, for exact-match cache keys."""
+    return " ".join(text.lower().split())
+
+def _cached_exact(task, model_type, user_input, func):
+    """Returns the cached result of func() for this exact (normalized) input, calling it on a miss."""
+    key = (task, model_type, _normalize_input(user_input))
+    with _red_flag_cache_lock:
+        if key in _red_flag_cache:
+            return _red_flag_cache[key]
+    value = func()
+    if value is not None:
+        with _red_flag_cache_lock:
+            _red_flag_cache[key] = value
+    return value
+
+def _combined_cache_namespace(model_type, patient_id, matched_appointment, history_doctor_name):
+    """
+    Summaries restate the patient's own symptoms and history, so they are only shared
+    between inputs of the same patient with the same appointment and doctor.
+    """
+    doc_id = matched_appointment.get("doc_id") if matched_appointment else None
+    return ("combined", model_type, patient_id, doc_id, history_doctor_name)
 
-# [configure_llm, get_specialty_for_symptoms, check_for_red_flags, find_best_match functions remain unchanged]
-# [For brevity, they are not repeated here, but they are still part of the file]
+# One GenerativeModel per (model name, system instruction), built on first use.
+_gemini_task_models = {}
 
+def _gemini_task_model(model, system_instruction):
+    """
+    Returns a Gemini model that shares the configured model's name but carries
+    the given task's static system instruction.
+    """
+    key = (model.model_name, system_instruction)
+    task_model = _gemini_task_models.get(key)
+    if task_model is None:
+        task_model = genai.GenerativeModel(model.model_name, system_instruction=system_instruction)
+        _gemini_task_models[key] = task_model
+    return task_model
+
+class _TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` calls per `period` seconds (bursts up to `rate`).
+    acquire() only blocks when the budget is actually used up.
+    """
+    def __init__(self, rate, period):
+        self.capacity = float(rate)
+        self.tokens = float(rate)
+        self.fill_rate = rate / period
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+            time.sleep(wait)
+
+# Process-wide LLM budget, shared by every request thread. Set up in configure_llm()
+# from LLM_REQUESTS_PER_MINUTE and LLM_MAX_CONCURRENT.
+_rate_limiter = None
+_llm_slots = None
+
+def _log_retry(retry_state):
+    """Logs each rate-limited attempt before tenacity sleeps."""
+    print(f"Resource exhausted (attempt {retry_state.attempt_number}). "
+          f"Retrying in {retry_state.next_action.sleep:.1f} seconds...")
+
+_RATE_LIMIT_ERRORS = (ResourceExhausted, RateLimitError)
+_RETRY_POLICY = dict(
+    retry=retry_if_exception_type(_RATE_LIMIT_ERRORS),
+    wait=wait_random_exponential(multiplier=1, max=20),
+    stop=stop_after_delay(30),
+    before_sleep=_log_retry,
+    reraise=True,
+)
+
+@contextmanager
+def _llm_slot():
+    """Takes a token from the shared rate limiter and holds a concurrency slot for the block."""
+    if _rate_limiter is not None:
+        _rate_limiter.acquire()
+    if _llm_slots is None:
+        yield
+        return
+    with _llm_slots:
+        yield
+
+@retry(**_RETRY_POLICY)
 def _call_llm_with_retry(api_call_fnc):
     """
-    Calls the LLM API with exponential backoff for ResourceExhausted errors.
+    Calls the LLM API, retrying rate-limit errors with jittered exponential
+    backoff. Jitter keeps workers from retrying in lockstep, and the total retry
+    time is capped at 30 seconds.
+    Every attempt first takes a token from the shared rate limiter and a
+    concurrency slot, so callers only wait when the budget is exhausted.
     """
-    retries = 3
-    delay = 5  # seconds
-    for i in range(retries):
-        try:
-            return api_call_fnc()
-        except ResourceExhausted as e:
-            if i < retries - 1:
-                print(f"Resource exhausted. Retrying in {delay} seconds...")
-                time.sleep(delay)
-                delay *= 2  # Exponential backoff
-            else:
-                print("LLM resource exhausted after multiple retries.")
-                raise e
-    return None # Should not be reached, but as a fallback
+    with _llm_slot():
+        return api_call_fnc()
+
+def _stream_llm_with_retry(api_call_fnc):
+    """
+    Streaming counterpart of _call_llm_with_retry: yields the chunks of the stream
+    returned by api_call_fnc. The concurrency slot is held until the stream is
+    exhausted or closed, not just while it is opened. Rate-limit errors raised while
+    opening or reading the stream are retried until the first chunk has been yielded;
+    after that the caller has already passed partial text on, so they are re-raised.
+    """
+    started = False
+    policy = {**_RETRY_POLICY, 'retry': retry_if_exception(lambda e: not started and isinstance(e, _RATE_LIMIT_ERRORS))}
+    for attempt in Retrying(**policy):
+        with attempt:
+            with _llm_slot():
+                for chunk in api_call_fnc():
+                    started = True
+                    yield chunk
 
 def configure_llm():
     """
     Configures and returns the appropriate LLM client based on environment variables.
     """
+    global _rate_limiter, _llm_slots
     load_dotenv()
+    _rate_limiter = _TokenBucket(int(os.getenv("LLM_REQUESTS_PER_MINUTE", "60")), 60)
+    _llm_slots = threading.BoundedSemaphore(int(os.getenv("LLM_MAX_CONCURRENT", "8")))
     use_gemini = os.getenv("USE_GEMINI", "true").lower() == "true"
     use_openai = os.getenv("USE_OPENAI", "false").lower() == "true"
 
@@ -40,7 +366,8 @@ def configure_llm():
         gemini_api_key = os.getenv("GEMINI_API_KEY")
         if not gemini_api_key:
             raise ValueError("GEMINI_API_KEY not found in .env file.")
-        genai.configure(api_key=gemini_api_key)
+        # The REST transport keeps one HTTP session (and its TLS connections) alive across requests.
+        genai.configure(api_key=gemini_api_key, transport="rest")
         model = genai.GenerativeModel(os.getenv("GEMINI_MODEL", "gemini-1.5-flash"))
         print("Using Gemini model.")
         return model, "gemini"
@@ -48,216 +375,428 @@ def configure_llm():
         openai_api_key = os.getenv("OPENAI_API_KEY")
         if not openai_api_key:
             raise ValueError("OPENAI_API_KEY not found in .env file.")
-        client = OpenAI(api_key=openai_api_key)
+        # One pooled HTTP/2 client for every request in this process: concurrent calls
+        # are multiplexed over a single warm connection instead of opening new ones.
+        http_client = httpx.Client(http2=True, timeout=30,
+                                   limits=httpx.Limits(max_connections=50, max_keepalive_connections=20))
+        atexit.register(http_client.close)
+        client = OpenAI(api_key=openai_api_key, http_client=http_client)
         print("Using OpenAI model.")
         return client, "openai"
     else:
         raise ValueError("No LLM is enabled. Please set USE_GEMINI or USE_OPENAI to true in the .env file.")
 
-def get_specialty_for_symptoms(model, model_type, user_input):
+def warmup(model, model_type):
+    """
+    Sends a one-token request so the HTTPS connection to the LLM provider is
+    already open when the first real chat turn arrives.
+    """
+    if model_type == "gemini":
+        model.generate_content("ok", generation_config={"max_output_tokens": 1})
+    elif model_type == "openai":
+        model.chat.completions.create(
+            model=OPENAI_STRUCTURED_MODEL,
+            max_tokens=1,
+            messages=[{"role": "user", "content": "ok"}]
+        )
+
+def keep_alive(model, model_type):
+    """
+    Makes a free metadata request over the pooled connection, so an idle
+    connection to the LLM provider isn't closed (and re-handshaked) before the next turn.
+    """
+    if model_type == "gemini":
+        model.count_tokens("ok")
+    elif model_type == "openai":
+        model.models.retrieve("gpt-3.5-turbo")
+
+_specialty_index = None
+_specialty_index_lock = threading.Lock()
+
+def _get_specialty_index():
+    """Embeds SPECIALTY_PROTOTYPES once: (labels per row, int8 vectors, specialty names)."""
+    global _specialty_index
+    if _specialty_index is None:
+        with _specialty_index_lock:
+            if _specialty_index is None:
+                names = list(SPECIALTY_PROTOTYPES)
+                labels, texts = [], []
+                for i, name in enumerate(names):
+                    for text in SPECIALTY_PROTOTYPES[name]:
+                        labels.append(i)
+                        texts.append(text)
+                _specialty_index = (np.array(labels), embeddings.quantize(embeddings.embed(texts)), names)
+    return _specialty_index
+
+def classify_specialty(user_input, query_vector=None):
+    """
+    Picks a specialty locally by comparing the input with each specialty's examples.
+    query_vector is the input's embedding, if the caller already computed it.
+
+    Returns:
+        tuple: (specialty, confidence), the softmax probability of the best specialty.
+    """
+    labels, vectors, names = _get_specialty_index()
+    if query_vector is None:
+        query_vector = embeddings.embed([user_input])[0]
+    scores = embeddings.similarities(vectors, query_vector)
+    # A specialty scores as its closest example.
+    best_per_specialty = np.full(len(names), -1.0)
+    np.maximum.at(best_per_specialty, labels, scores)
+    weights = np.exp((best_per_specialty - best_per_specialty.max()) / _SPECIALTY_TEMPERATURE)
+    probabilities = weights / weights.sum()
+    best = int(np.argmax(probabilities))
+    return names[best], float(probabilities[best])
+
+def get_specialty_for_symptoms(model, model_type, user_input, query_vector=None):
     """
     Determines the most relevant medical specialty for a given set of symptoms.
+    Clear cases are classified locally; the LLM is only asked when that is unsure.
+    The input is embedded once (unless query_vector is given) for both steps.
     """
-    prompt = f'''
-    You are a medical expert. Based on the following symptoms, what is the most appropriate medical specialty to consult? 
-    Choose from common specialties like General Physician, ENT, Dermatologist, Orthopedic, Gynecologist, Cardiologist, etc.
-    Return only the name of the specialty.
+    if query_vector is None:
+        query_vector = embeddings.embed([user_input])[0]
+    specialty, confidence = classify_specialty(user_input, query_vector)
+    if confidence >= SPECIALTY_MIN_CONFIDENCE:
+        return specialty
 
-    Symptoms: "{user_input}"
-    Specialty:
-    '''
+    prompt = f'Symptoms: "{user_input}"\nSpecialty:'
     
     def api_call():
         if model_type == "gemini":
-            response = model.generate_content(prompt)
+            response = _gemini_task_model(model, SPECIALTY_SYSTEM_PROMPT).generate_content(prompt)
             return response.text.strip()
         elif model_type == "openai":
             response = model.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
-                    {"role": "system", "content": "You are a medical expert who only responds with the name of a medical specialty."},
+                    {"role": "system", "content": SPECIALTY_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ]
             )
             return response.choices[0].message.content.strip()
 
-    return _call_llm_with_retry(api_call)
+    return _semantic_cache.get_or_call(("specialty", model_type), user_input, lambda: _call_llm_with_retry(api_call),
+                                       query_vector)
+
+def _is_negated(text, start):
+    """True if a negation word precedes position `start` closely, within the same clause."""
+    clause = re.split(r"[.,;:!?]", text[:start])[-1]
+    preceding = re.findall(r"[\w']+", clause)[-RED_FLAG_NEGATION_WINDOW:]
+    return any(word in RED_FLAG_NEGATIONS for word in preceding)
+
+def scan_red_flags(user_input):
+    """
+    Scans the input for red-flag phrases with a single Aho-Corasick pass over the
+    phrases of every language in RED_FLAG_PHRASES and RED_FLAG_WEAK_PHRASES.
+
+    Returns:
+        str or None: "strong" for a whole-word RED_FLAG_PHRASES hit that isn't negated,
+        "weak" if there are only weak or negated hits, None without any hit.
+    """
+    text = _normalize_for_scan(user_input)
+    found = None
+    for end, (_, phrase, strong) in _red_flag_automaton.iter(text):
+        start = end - len(phrase) + 1
+        before = text[start - 1] if start > 0 else " "
+        after = text[end + 1] if end + 1 < len(text) else " "
+        if before.isalnum() or after.isalnum():
+            continue
+        if strong and not _is_negated(text, start):
+            return "strong"
+        found = "weak"
+    return found
+
+def prefilter_red_flags(user_input):
+    """
+    Decides clear-cut red-flag cases locally (see scan_red_flags).
+
+    Returns:
+        bool or None: True for a strong red-flag hit, False for pure small talk
+        (see SMALL_TALK_WORDS), None if the LLM has to decide.
+    """
+    hit = scan_red_flags(user_input)
+    if hit == "strong":
+        return True
+    if hit is None:
+        words = re.findall(r"\w+", _normalize_for_scan(user_input))
+        if words and all(word in SMALL_TALK_WORDS for word in words):
+            return False
+    return None
 
 def check_for_red_flags(model, model_type, user_input):
     """
     Checks if the user input contains any red flag symptoms.
+    Clear-cut inputs are decided by prefilter_red_flags without calling the LLM.
     """
-    prompt = f'''
-    You are a medical triage expert. Your task is to determine if the user\'s statement contains any critical, life-threatening symptoms.
-    These are considered "red flags".
-
-    Red flag symptoms include, but are not limited to:
-    - Chest pain or pressure
-    - Difficulty breathing or shortness of breath
-    - Severe headache, especially if sudden
-    - Weakness, numbness, or paralysis, especially on one side of the body
-    - Confusion or altered mental state
-    - Slurred speech
-    - Seizures
-    - High fever with a stiff neck
-    - Severe abdominal pain
-    - Uncontrolled bleeding
-    - Thoughts of self-harm or suicide
-    - Mention of a serious diagnosis like \'cancer\', \'heart attack\', \'stroke\'
-
-    User input: "{user_input}"
-
-    Based on this input, does it contain any red flag symptoms? Answer with only "true" or "false".
-    '''
+    prefiltered = prefilter_red_flags(user_input)
+    if prefiltered is not None:
+        return prefiltered
+
+    prompt = f'User input: "{user_input}"'
     
     def api_call():
         if model_type == "gemini":
-            response = model.generate_content(prompt)
+            response = _gemini_task_model(model, RED_FLAG_SYSTEM_PROMPT).generate_content(prompt)
             return response.text.strip().lower() == "true"
         elif model_type == "openai":
             response = model.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
-                    {"role": "system", "content": "You are a medical triage expert who only responds with 'true' or 'false'."},
+                    {"role": "system", "content": RED_FLAG_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ]
             )
             return response.choices[0].message.content.strip().lower() == "true"
 
-    return _call_llm_with_retry(api_call)
+    return _cached_exact("red_flag", model_type, user_input, lambda: _call_llm_with_retry(api_call))
 
-def find_best_match(model, model_type, user_symptoms, appointments):
+class AppointmentIndex:
     """
-    Uses the LLM to find the best matching past appointment.
+    The symptom embeddings of a patient's most recent appointments,
+    computed once so that each turn only has to embed the new input.
     """
-    if not appointments:
-        return None
-
-    prompt_appointments = []
-    for app in appointments:
-        prompt_appointments.append({
-            "doc_id": app.get("doc_id"),
-            "appointmentDate": app.get("appointmentDate"),
-            "symptomsText": app.get("symptomsText")
-        })
-
-    prompt = f'''
-    You are a medical data analysis expert. A patient has reported new symptoms, and I need you to find the most relevant past appointment from their history.
-
-    The patient's new symptoms are: "{user_symptoms}"
+    def __init__(self, appointments, previous=None):
+        candidates = [app for app in appointments if app.get("symptomsText")]
+        candidates.sort(key=lambda app: str(app.get("appointmentDate") or ""), reverse=True)
+        self.candidates = candidates[:MAX_MATCH_CANDIDATES]
+        self.vectors = self._embed(previous) if self.candidates else None
+
+    def _embed(self, previous):
+        """
+        Embeds the candidates' symptoms. Rows of `previous` are reused for appointments
+        whose symptoms text is unchanged, so a refresh only embeds new or edited ones.
+        """
+        known = {}
+        if previous is not None and previous.vectors is not None:
+            for app, vector in zip(previous.candidates, previous.vectors):
+                known[(app.get("doc_id"), app["symptomsText"])] = vector
+        rows = [known.get((app.get("doc_id"), app["symptomsText"])) for app in self.candidates]
+        missing = [i for i, row in enumerate(rows) if row is None]
+        if missing:
+            fresh = embeddings.quantize(embeddings.embed_appointments([self.candidates[i] for i in missing]))
+            for i, row in zip(missing, fresh):
+                rows[i] = row
+        return np.stack(rows)
+
+def build_appointment_index(appointments, previous=None):
+    """
+    Embeds a patient's appointments once for repeated find_best_match calls.
+    The candidates are always the given appointment dicts; only the embeddings of
+    unchanged symptoms are carried over from `previous`.
+    """
+    return AppointmentIndex(appointments, previous)
 
-    Here is a list of their past appointments in JSON format:
-    {json.dumps(prompt_appointments, indent=2)}
+def find_best_match(user_symptoms, appointment_index, query_vector=None):
+    """
+    Finds the past appointment whose symptoms are most similar to the new ones.
+    Similarity is the cosine of local sentence embeddings, so no LLM call is needed.
 
-    Your task is to compare the new symptoms with the 'symptomsText' of each past appointment.
-    **Crucial Rule:** Only return a match if the new symptoms are genuinely and semantically similar to the past symptoms. A vague similarity is not enough.
-    For example, if the new symptom is "cancer", and the past symptoms are "fever and cough", this is NOT a match.
-    If the new symptom is "sore throat and fever" and a past symptom is "throat pain, fever, cough", this IS a good match.
+    Args:
+        user_symptoms (str): The new symptoms.
+        appointment_index (AppointmentIndex): From build_appointment_index().
+        query_vector (np.ndarray, optional): The embedding of user_symptoms, if already computed.
+    """
+    if not appointment_index.candidates:
+        return None
+    if query_vector is None:
+        query_vector = embeddings.embed([user_symptoms])[0]
+    scores = embeddings.similarities(appointment_index.vectors, query_vector)
+    best = int(np.argmax(scores))
+    if scores[best] < BEST_MATCH_THRESHOLD:
+        return None
+    return appointment_index.candidates[best]
 
-    If you find a genuinely similar appointment, respond with only the JSON object of that single best match.
-    If you do NOT find any good match, you MUST respond with an empty JSON object: {{}}.
-    '''
+def analyze_turn(model, model_type, user_input, matched_appointment=None, history_doctor_name=None,
+                 include_summary=False, patient_id=None):
+    """
+    Answers the red-flag and specialty questions for a turn in a single
+    schema-constrained JSON LLM call, instead of one call per question. With include_summary,
+    the same call also writes the summary of the combined response for the
+    given matched appointment of patient_id (see generate_combined_response).
+
+    Returns:
+        dict: {'red_flag': bool, 'specialty': str or None} (plus 'summary': str
+        with include_summary), or None if the model's reply could not be parsed.
+    """
+    if include_summary:
+        system_prompt, schema, schema_name = TURN_RESPONSE_SYSTEM_PROMPT, TURN_RESPONSE_SCHEMA, "turn_response"
+        prompt = _build_combined_prompt(user_input, matched_appointment, history_doctor_name)
+        task = _combined_cache_namespace(model_type, patient_id, matched_appointment, history_doctor_name)
+    else:
+        system_prompt, schema, schema_name = TURN_ANALYSIS_SYSTEM_PROMPT, TURN_ANALYSIS_SCHEMA, "turn_analysis"
+        prompt = f'The patient\'s new symptoms are: "{user_input}"'
+        task = "turn_analysis"
 
     def api_call():
         if model_type == "gemini":
-            response = model.generate_content(prompt)
-            text_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-            try:
-                return json.loads(text_response)
-            except json.JSONDecodeError:
-                return None
+            response = _gemini_task_model(model, system_prompt).generate_content(
+                prompt, generation_config={"response_mime_type": "application/json", "response_schema": schema}
+            )
+            return response.text
         elif model_type == "openai":
             response = model.chat.completions.create(
-                model="gpt-3.5-turbo-1106",
-                response_format={ "type": "json_object" },
+                model=OPENAI_STRUCTURED_MODEL,
+                response_format=_openai_response_format(schema_name, schema),
                 messages=[
-                    {"role": "system", "content": "You are a helpful medical data analyst that only responds with JSON."},
+                    {"role": "system", "content": system_prompt},
                     {"role": "user", "content": prompt}
                 ]
             )
-            try:
-                return json.loads(response.choices[0].message.content)
-            except json.JSONDecodeError:
-                return None
-
-    best_match = _call_llm_with_retry(api_call)
+            return response.choices[0].message.content
 
-    if not best_match or not best_match.get("doc_id"):
-        return None
+    def analyze():
+        try:
+            analysis = orjson.loads(_call_llm_with_retry(api_call))
+        except (TypeError, orjson.JSONDecodeError):
+            return None
+        if not isinstance(analysis, dict) or not isinstance(analysis.get("red_flag"), bool):
+            return None
+
+        specialty = analysis.get("specialty")
+        result = {
+            "red_flag": analysis["red_flag"],
+            "specialty": specialty.strip() if isinstance(specialty, str) and specialty.strip() else None,
+        }
+        if include_summary:
+            summary = analysis.get("summary")
+            if not isinstance(summary, str) or not summary.strip():
+                return None
+            result["summary"] = summary.strip()
+        return result
 
-    for app in appointments:
-        if app.get("doc_id") == best_match.get("doc_id"):
-            return app
-    return None
+    return _cached_exact(task, model_type, user_input, analyze)
 
-def generate_combined_response(model, model_type, user_input, matched_appointment, history_doctor_name, routed_doctor_name):
+def _build_combined_prompt(user_input, matched_appointment, history_doctor_name):
     """
-    Generates a combined response showing the AI suggestion AND the routing information.
+    Builds the user prompt for the summary part of the combined response.
     """
-    # Part 1: Generate the AI suggestion text (based on past history)
+    # The AI suggestion text (based on past history)
     ai_suggestion_text = ""
     if not matched_appointment:
         ai_suggestion_text = "After reviewing your past medical records, no appointments with similar symptoms were found."
     else:
-        patient_name = matched_appointment.get('patientName', 'there')
         appointment_date = matched_appointment.get('appointmentDate')
         display_history_doctor = history_doctor_name if history_doctor_name else "the doctor"
         symptoms = matched_appointment.get('symptomsText')
-        prescriptions = matched_appointment.get('prescriptions', [])
-
-        prescription_list = []
-        for p in prescriptions:
-            if p.get('name'):
-                p_str = f"- {p['name']} {p.get('strength', '')}".strip()
-                if p.get('purpose'):
-                    p_str += f" (for {p['purpose']})"
-                prescription_list.append(p_str)
-        
-        prescription_str = '\n'.join(prescription_list) if prescription_list else "No specific prescriptions were listed."
-        
-        ai_suggestion_text = (
-            f"Based on your symptoms, I found a past appointment with Dr. {display_history_doctor} on {appointment_date} for similar symptoms ('{symptoms}').\n"
-            f"The suggested prescription at that time was:\n{prescription_str}"
-        )
+        ai_suggestion_text = f"Based on your symptoms, I found a past appointment with Dr. {display_history_doctor} on {appointment_date} for similar symptoms ('{symptoms}')."
 
-    # Part 2: Generate the routing message ONLY if a doctor has been assigned
-    routing_message = ""
-    if routed_doctor_name:
-        routing_message = f"\n\nThis suggestion has now been forwarded to a real doctor, Dr. {routed_doctor_name}, for review. Please wait for the doctor's approval before taking any action."
-    
-    # Part 3: Generate the final combined prompt
-    final_call_to_action = "You must wait for a doctor's final approval." if routed_doctor_name else "Please consult a doctor for an accurate diagnosis."
-
-    prompt = f'''
-    You are a helpful medical assistant chatbot.
-    A user has described their symptoms as: "{user_input}".
+    prompt = f'''User's symptoms: "{user_input}"
 
-    Here is the AI's analysis based on their past records:
-    ---
-    {ai_suggestion_text}
-    ---
-    {routing_message}
+AI's analysis based on their past records:
+---
+{ai_suggestion_text}
+---'''
+    return prompt
 
-    Your task is to combine this information into a single, clear message for the user.
-    1. Present the AI's analysis.
-    2. If a routing message exists, present it.
-    3. Add a strong disclaimer at the end. The disclaimer's message should be: "{final_call_to_action}"
+def _format_medicine(matched_appointment):
+    """The prescription of the matched appointment as a bullet list, or '' without a match."""
+    if not matched_appointment:
+        return ""
+    prescription_list = []
+    for p in matched_appointment.get('prescriptions', []):
+        if p.get('name'):
+            p_str = f"- {p['name']} {p.get('strength', '')}".strip()
+            if p.get('purpose'):
+                p_str += f" (for {p['purpose']})"
+            prescription_list.append(p_str)
+
+    prescription_str = '\n'.join(prescription_list) if prescription_list else "No specific prescriptions were listed."
+    return f"The suggested prescription at that time was:\n{prescription_str}"
+
+def _format_routed_sentence(routed_doctor_name):
+    """The routing message (only if a doctor has been assigned) followed by the disclaimer."""
+    if routed_doctor_name:
+        return (f"This suggestion has now been forwarded to a real doctor, Dr. {routed_doctor_name}, for review. "
+                "Please wait for the doctor's approval before taking any action.")
+    return "Please consult a doctor for an accurate diagnosis."
+
+@dataclass(slots=True)
+class CombinedResponse:
+    """The parts of a combined response. 'medicine' is '' when no appointment matched."""
+    summary: str
+    medicine: str
+    routed_sentence: str
+
+def build_combined_response(summary, matched_appointment, routed_doctor_name):
+    """Completes an LLM-written summary into a CombinedResponse."""
+    return CombinedResponse(summary, _format_medicine(matched_appointment), _format_routed_sentence(routed_doctor_name))
+
+def generate_combined_response(model, model_type, patient_id, user_input, matched_appointment, history_doctor_name, routed_doctor_name,
+                               query_vector=None):
+    """
+    Generates a combined response showing the AI suggestion AND the routing information.
+    Only the summary comes from the LLM; the prescription and routing text are templated,
+    so the same response can be shown to the user and (without routing) stored for the doctor.
+    query_vector is the input's embedding for the semantic cache, if the caller already has it.
 
-    Generate a friendly, reassuring, and well-structured response.
-    '''
+    Returns:
+        CombinedResponse: the summary, medicine and routed_sentence texts.
+    """
+    prompt = _build_combined_prompt(user_input, matched_appointment, history_doctor_name)
 
     def api_call():
         if model_type == "gemini":
-            response = model.generate_content(prompt)
+            response = _gemini_task_model(model, COMBINED_RESPONSE_SYSTEM_PROMPT).generate_content(prompt)
             return response.text.strip()
         elif model_type == "openai":
             response = model.chat.completions.create(
                 model="gpt-3.5-turbo",
                 messages=[
-                    {"role": "system", "content": "You are a helpful medical assistant chatbot."},
+                    {"role": "system", "content": COMBINED_RESPONSE_SYSTEM_PROMPT},
                     {"role": "user", "content": prompt}
                 ]
             )
             return response.choices[0].message.content.strip()
 
-    return _call_llm_with_retry(api_call)
\ No newline at end of file
+    namespace = _combined_cache_namespace(model_type, patient_id, matched_appointment, history_doctor_name)
+    summary = _semantic_cache.get_or_call(namespace, user_input, lambda: _call_llm_with_retry(api_call), query_vector)
+    return build_combined_response(summary, matched_appointment, routed_doctor_name)
+
+def generate_combined_response_stream(model, model_type, patient_id, user_input, matched_appointment, history_doctor_name, routed_doctor_name,
+                                      query_vector=None):
+    """
+    Same as generate_combined_response, but yields the reply in text chunks: the summary
+    as the LLM produces it (or whole, if cached for a similar input), then the medicine
+    and routing paragraphs. The generator's return value is the CombinedResponse.
+    """
+    namespace = _combined_cache_namespace(model_type, patient_id, matched_appointment, history_doctor_name)
+    if query_vector is None:
+        query_vector = embeddings.embed([user_input])[0]
+    summary = _semantic_cache.get(namespace, query_vector)
+    if summary is not None:
+        yield summary
+    else:
+        prompt = _build_combined_prompt(user_input, matched_appointment, history_doctor_name)
+
+        def api_call():
+            if model_type == "gemini":
+                return _gemini_task_model(model, COMBINED_RESPONSE_SYSTEM_PROMPT).generate_content(prompt, stream=True)
+            elif model_type == "openai":
+                return model.chat.completions.create(
+                    model="gpt-3.5-turbo",
+                    stream=True,
+                    messages=[
+                        {"role": "system", "content": COMBINED_RESPONSE_SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ]
+                )
+
+        chunks = []
+        for chunk in _stream_llm_with_retry(api_call):
+            if model_type == "gemini":
+                text = chunk.text
+            else:
+                text = chunk.choices[0].delta.content if chunk.choices else None
+            if text:
+                chunks.append(text)
+                yield text
+        summary = "".join(chunks).strip()
+        if summary:
+            _semantic_cache.put(namespace, query_vector, summary)
+
+    response = build_combined_response(summary, matched_appointment, routed_doctor_name)
+    for part in (response.medicine, response.routed_sentence):
+        if part:
+            yield "\n\n" + part
+    return response
@@ -1,118 +1,402 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any
+
+from cachetools import TTLCache
 
+import embeddings
 import firebase_client
 import llm_client
 
-# Global variables to hold the initialized clients
-model = None
-model_type = ''
+@dataclass(frozen=True, slots=True)
+class Clients:
+    """
+    The configured LLM client and its settings, created by initialize_clients()
+    and passed to every call that needs them.
+    """
+    llm: Any
+    llm_type: str
+    # False switches back to one LLM call per triage step and reply.
+    fused_analysis: bool = True
+
+# Shared pool used to overlap independent Firestore and LLM calls within a turn.
+# The Firebase and LLM SDKs are blocking, so threads give us the overlap without
+# rewriting every client call as a coroutine.
+_executor = ThreadPoolExecutor(max_workers=8)
 
-def initialize_clients():
+# Pending-approval writes still in flight. The user's reply doesn't wait for them;
+# flush_pending_writes() does, before the process exits.
+_pending_writes = set()
+_pending_writes_lock = threading.Lock()
+
+APPOINTMENTS_TTL = int(os.getenv("APPOINTMENTS_TTL", "300"))
+# Seconds the CLI waits on input() before it prefetches for the next turn.
+PREFETCH_DELAY = 2.0
+
+class AppointmentsCache:
     """
-    Initializes the Firebase and LLM clients and stores them in global variables.
+    A patient's appointment history and its embedding index, fetched once and
+    reused across turns until it is older than the TTL or invalidated.
+    """
+    def __init__(self, patient_id):
+        self.patient_id = patient_id
+        self.appointments = []
+        self.index = None
+        self.fetched_at = None
+        self._lock = threading.Lock()
+
+    def maybe_refresh(self, ttl=APPOINTMENTS_TTL):
+        """Re-reads the appointments from Firestore if they are stale. Returns self."""
+        with self._lock:
+            if self.fetched_at is None or time.monotonic() - self.fetched_at > ttl:
+                appointments = firebase_client.get_patient_appointments_by_id(self.patient_id)
+                # Rebuilt from the fresh dicts, so edited prescriptions and doctors show up;
+                # embeddings are reused for symptoms that haven't changed.
+                self.index = llm_client.build_appointment_index(appointments, self.index)
+                self.appointments = appointments
+                self.fetched_at = time.monotonic()
+        return self
+
+    def invalidate(self):
+        """Forces the next maybe_refresh() to re-read the appointments."""
+        with self._lock:
+            self.fetched_at = None
+
+# Appointment caches for the patients served through get_chatbot_response
+# without an explicit cache (e.g. the web app).
+_appointments_caches = TTLCache(maxsize=1024, ttl=1800)
+_appointments_caches_lock = threading.Lock()
+
+def _appointments_cache_for(patient_id):
+    """Returns the shared AppointmentsCache for a patient, creating it on first use."""
+    with _appointments_caches_lock:
+        cache = _appointments_caches.get(patient_id)
+        if cache is None:
+            cache = _appointments_caches[patient_id] = AppointmentsCache(patient_id)
+        return cache
+
+def initialize_clients(warmup=True):
+    """
+    Initializes the Firebase and LLM clients and, unless warmup=False, warms them
+    up (see warmup_clients) before returning.
+
+    Returns:
+        Clients: The clients to pass to get_chatbot_response and friends.
     """
-    global model, model_type
     try:
         firebase_client.initialize_firebase()
         model, model_type = llm_client.configure_llm()
+        clients = Clients(model, model_type, os.getenv("USE_FUSED_ANALYSIS", "true").lower() == "true")
         print("Firebase and LLM clients initialized successfully.")
     except (ValueError, FileNotFoundError) as e:
         print(f"Error during initialization: {e}")
         raise
+    if warmup:
+        warmup_clients(clients)
+    return clients
+
+def _timed_warmup(name, func, *args):
+    """Runs one warmup step and logs how long it took, so cold-start regressions are visible."""
+    start = time.perf_counter()
+    try:
+        func(*args)
+        print(f"Warmup of {name} took {time.perf_counter() - start:.2f}s.")
+    except Exception as e:
+        print(f"Warmup of {name} failed after {time.perf_counter() - start:.2f}s: {e}")
 
-def _format_response_to_string(response_data):
+def warmup_clients(clients):
     """
-    Formats the response data into a single string.
+    Primes the LLM connection, the Firestore channels and the embedding model so
+    the first user turn doesn't pay their cold-start cost. The three run concurrently;
+    failures are only logged.
     """
-    if isinstance(response_data, dict):
-        # Assuming keys like 'summary' and 'medicine'
-        summary = response_data.get('summary', '')
-        medicine = response_data.get('medicine', '')
-        return f"{summary}\n{medicine}"
-    elif isinstance(response_data, str):
-        return response_data
-    else:
-        return str(response_data)
+    start = time.perf_counter()
+    wait([
+        _executor.submit(_timed_warmup, "LLM", llm_client.warmup, clients.llm, clients.llm_type),
+        _executor.submit(_timed_warmup, "Firestore", firebase_client.warmup),
+        # Loads the embedding model and embeds the specialty examples.
+        _executor.submit(_timed_warmup, "embeddings", llm_client.classify_specialty, "warmup"),
+    ])
+    print(f"Client warmup finished in {time.perf_counter() - start:.2f}s.")
 
-import time
-def get_chatbot_response(patient_id, user_input):
-    time.sleep(1) # Add a 1-second delay to avoid hitting the API rate limit
-    """
-    Handles the core chatbot logic for a single user input.
+# Reply templates, bound once. The doctor's copy leaves out the routing sentence;
+# it is only stored for routed turns, which always have a matched prescription.
+_FMT = "{0.summary}\n\n{0.medicine}\n\n{0.routed_sentence}".format
+_FMT_NO_MEDICINE = "{0.summary}\n\n{0.routed_sentence}".format
+_FMT_DOCTOR = "{0.summary}\n\n{0.medicine}".format
 
-    Args:
-        patient_id (str): The ID of the patient.
-        user_input (str): The user's message/symptoms.
+def _format_response_to_string(response):
+    """Formats a CombinedResponse into the text shown to the user."""
+    return _FMT(response) if response.medicine else _FMT_NO_MEDICINE(response)
+
+EMERGENCY_MESSAGE = ("**EMERGENCY WARNING**...\n" 
+                     "Based on your symptoms, you may require immediate medical attention.\n" 
+                     "Please contact your local emergency services or go to the nearest hospital right away.")
+
+def _completed(value):
+    """Wraps an already-known value in a finished Future."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+def _analyze_turn(clients, appointments_cache, user_input):
+    """
+    Runs the triage steps for a user turn: red-flag check, history match and specialty.
 
     Returns:
-        str: The chatbot's response message.
+        tuple: (red_flag, matched_appointment, specialty_future, query_vector). The specialty
+        is only looked up when an appointment matched; it is returned as a Future so callers
+        can start other reads while an LLM call for it may still be running. query_vector is
+        the input's embedding, computed once and shared by every step that needs it.
     """
-    if not model or not model_type:
-        return "Error: Clients are not initialized. Please run initialize_clients() first."
+    # Refresh the patient's history now (if stale) so the Firestore read overlaps the LLM call.
+    appointments_future = _executor.submit(appointments_cache.maybe_refresh)
 
-    # 1. Red Flag Check
-    if llm_client.check_for_red_flags(model, model_type, user_input):
-        return ("**EMERGENCY WARNING**...\n" 
-                "Based on your symptoms, you may require immediate medical attention.\n" 
-                "Please contact your local emergency services or go to the nearest hospital right away.")
+    # 1. Red Flag Check (together with the specialty when fused analysis is on).
+    # Clear-cut inputs are decided locally and skip the LLM entirely.
+    analysis = None
+    red_flag = llm_client.prefilter_red_flags(user_input)
+    if red_flag is None and clients.fused_analysis:
+        analysis = llm_client.analyze_turn(clients.llm, clients.llm_type, user_input)
+        if analysis is None:
+            print("Fused turn analysis failed. Falling back to per-step LLM calls.")
+    specialty_future = None
+    query_vector = None
+    if analysis is not None:
+        red_flag = analysis['red_flag']
+    elif red_flag is None:
+        # Ask for the specialty alongside the red-flag check, so it is ready if the
+        # history matches instead of costing another round trip afterwards.
+        query_vector = embeddings.embed([user_input])[0]
+        specialty_future = _executor.submit(llm_client.get_specialty_for_symptoms, clients.llm, clients.llm_type,
+                                            user_input, query_vector)
+        red_flag = llm_client.check_for_red_flags(clients.llm, clients.llm_type, user_input)
+    if red_flag:
+        return True, None, None, None
+    # The reply's semantic cache needs the embedding anyway, so it is computed before the history match.
+    if query_vector is None:
+        query_vector = embeddings.embed([user_input])[0]
 
     # 2. Fetch patient history
-    patient_appointments = firebase_client.get_patient_appointments_by_id(patient_id)
+    appointment_index = appointments_future.result().index
 
     # 3. Find best match from history
-    matched_appointment = llm_client.find_best_match(model, model_type, user_input, patient_appointments)
+    matched_appointment = llm_client.find_best_match(user_input, appointment_index, query_vector)
+    if not matched_appointment:
+        return False, None, None, query_vector
+
+    if analysis is not None:
+        specialty_future = _completed(analysis['specialty'])
+    elif specialty_future is None:
+        specialty_future = _executor.submit(llm_client.get_specialty_for_symptoms, clients.llm, clients.llm_type,
+                                            user_input, query_vector)
+    return False, matched_appointment, specialty_future, query_vector
+
+def _prepare_reply(clients, appointments_cache, user_input):
+    """
+    Runs triage, history matching and doctor routing for a user turn.
+
+    Returns:
+        tuple or None: (reply_args, routed_doctor_id), where reply_args are the keyword
+        arguments for llm_client.generate_combined_response(_stream). None if the
+        input contains red flags.
+    """
+    # 1-3. Red flag check, history match and specialty
+    red_flag, matched_appointment, specialty_future, query_vector = _analyze_turn(clients, appointments_cache, user_input)
+    if red_flag:
+        return None
 
     # 4. Main Logic Branching
+    history_doctor_name = None
+    routed_doctor_id, routed_doctor_name = None, None
     if matched_appointment:
         # --- IF A MATCH IS FOUND: ROUTE TO DOCTOR ---
-        history_doctor_name = None
+        # The previous doctor's name is read while the specialty and routed doctor are resolved.
         staff_id = matched_appointment.get('staffId')
-        if staff_id:
-            history_doctor_name = firebase_client.get_doctor_name(staff_id)
+        history_name_future = _executor.submit(firebase_client.get_doctor_name, staff_id) if staff_id else None
 
-        specialty = llm_client.get_specialty_for_symptoms(model, model_type, user_input)
-        
-        routed_doctor_id, routed_doctor_name = None, None
+        specialty = specialty_future.result()
         if specialty:
             routed_doctor_id, routed_doctor_name = firebase_client.find_doctor_by_specialty(specialty)
+        if history_name_future:
+            history_doctor_name = history_name_future.result()
+    # --- IF NO MATCH IS FOUND: THE REPLY TELLS THE USER TO CONSULT A DOCTOR ---
 
-        final_response = llm_client.generate_combined_response(
-            model=model, 
-            model_type=model_type, 
-            user_input=user_input, 
-            matched_appointment=matched_appointment, 
-            history_doctor_name=history_doctor_name,
-            routed_doctor_name=routed_doctor_name
-        )
-        
-        if routed_doctor_id:
-            ai_suggestion_for_db = llm_client.generate_combined_response(model, model_type, user_input, matched_appointment, history_doctor_name, None)
-            firebase_client.create_pending_approval(
-                patient_id=patient_id,
-                doctor_id=routed_doctor_id,
-                symptoms=user_input,
-                ai_output=_format_response_to_string(ai_suggestion_for_db)
-            )
-        
-        return _format_response_to_string(final_response)
+    reply_args = {
+        'patient_id': appointments_cache.patient_id,
+        'user_input': user_input,
+        'matched_appointment': matched_appointment,
+        'history_doctor_name': history_doctor_name,
+        'routed_doctor_name': routed_doctor_name,
+        'query_vector': query_vector,
+    }
+    return reply_args, routed_doctor_id
+
+def _respond_in_one_call(clients, appointments_cache, user_input):
+    """
+    Answers a turn with a single LLM call: the history is matched locally first, so
+    the red-flag check, the specialty and the reply summary can share one prompt.
 
+    Returns:
+        tuple or None: (CombinedResponse, routed_doctor_id), or None if the input
+        contains red flags.
+    """
+    # This path pays for the LLM call anyway, so only a strong, un-negated hit ends the
+    # turn locally; weak or negated hits are left to the model's red-flag verdict.
+    if llm_client.scan_red_flags(user_input) == "strong":
+        return None
+
+    matched_appointment = llm_client.find_best_match(user_input, appointments_cache.maybe_refresh().index)
+    staff_id = matched_appointment.get('staffId') if matched_appointment else None
+    history_doctor_name = firebase_client.get_doctor_name(staff_id) if staff_id else None
+
+    analysis = llm_client.analyze_turn(clients.llm, clients.llm_type, user_input, matched_appointment,
+                                       history_doctor_name, include_summary=True,
+                                       patient_id=appointments_cache.patient_id)
+    if analysis is None:
+        print("Single-call turn analysis failed. Falling back to separate LLM calls.")
+        return _respond_step_by_step(clients, appointments_cache, user_input, matched_appointment, history_doctor_name)
+    # The model's red-flag verdict always counts.
+    if analysis['red_flag']:
+        return None
+
+    routed_doctor_id, routed_doctor_name = None, None
+    if matched_appointment and analysis['specialty']:
+        routed_doctor_id, routed_doctor_name = firebase_client.find_doctor_by_specialty(analysis['specialty'])
+    response = llm_client.build_combined_response(analysis['summary'], matched_appointment, routed_doctor_name)
+    return response, routed_doctor_id
+
+def _respond_step_by_step(clients, appointments_cache, user_input, matched_appointment, history_doctor_name):
+    """
+    Fallback for _respond_in_one_call when the single-call reply can't be parsed: asks
+    for the red flag, the specialty and the summary separately, reusing the history
+    match and doctor name already computed for the turn.
+    """
+    query_vector = embeddings.embed([user_input])[0]
+    specialty_future = None
+    if matched_appointment:
+        specialty_future = _executor.submit(llm_client.get_specialty_for_symptoms, clients.llm, clients.llm_type,
+                                            user_input, query_vector)
+    if llm_client.check_for_red_flags(clients.llm, clients.llm_type, user_input):
+        return None
+
+    routed_doctor_id, routed_doctor_name = None, None
+    specialty = specialty_future.result() if specialty_future else None
+    if specialty:
+        routed_doctor_id, routed_doctor_name = firebase_client.find_doctor_by_specialty(specialty)
+    response = llm_client.generate_combined_response(clients.llm, clients.llm_type, appointments_cache.patient_id,
+                                                     user_input, matched_appointment, history_doctor_name,
+                                                     routed_doctor_name, query_vector)
+    return response, routed_doctor_id
+
+def _record_pending_approval(appointments_cache, routed_doctor_id, symptoms, response):
+    """
+    Stores the AI suggestion (without the routing message) for the routed doctor to review.
+    """
+    # All Firestore writes for this turn go into one batch and are committed together.
+    batch = firebase_client.new_batch()
+    firebase_client.create_pending_approval(
+        patient_id=appointments_cache.patient_id,
+        doctor_id=routed_doctor_id,
+        symptoms=symptoms,
+        ai_output=_FMT_DOCTOR(response),
+        batch=batch
+    )
+    firebase_client.commit_batch(batch)
+    appointments_cache.invalidate()
+
+def _on_write_done(future):
+    """Forgets a finished background write and logs it if it failed."""
+    with _pending_writes_lock:
+        _pending_writes.discard(future)
+    error = future.exception()
+    if error:
+        print(f"Error saving pending approval: {error}")
+
+def _record_pending_approval_in_background(*args):
+    """Runs _record_pending_approval on the executor without waiting for it."""
+    future = _executor.submit(_record_pending_approval, *args)
+    with _pending_writes_lock:
+        _pending_writes.add(future)
+    future.add_done_callback(_on_write_done)
+
+def flush_pending_writes(timeout=None):
+    """Waits for the background pending-approval writes to finish."""
+    with _pending_writes_lock:
+        futures = list(_pending_writes)
+    wait(futures, timeout=timeout)
+
+def get_chatbot_response(clients, patient_id, user_input, appointments_cache=None):
+    """
+    Handles the core chatbot logic for a single user input.
+
+    Args:
+        clients (Clients): From initialize_clients().
+        patient_id (str): The ID of the patient.
+        user_input (str): The user's message/symptoms.
+        appointments_cache (AppointmentsCache, optional): The patient's cached history.
+            A shared per-patient cache is used if omitted.
+
+    Returns:
+        str: The chatbot's response message.
+    """
+    appointments_cache = appointments_cache or _appointments_cache_for(patient_id)
+    if clients.fused_analysis:
+        prepared = _respond_in_one_call(clients, appointments_cache, user_input)
+        if prepared is None:
+            return EMERGENCY_MESSAGE
+        final_response, routed_doctor_id = prepared
     else:
-        # --- IF NO MATCH IS FOUND: TELL USER TO CONSULT DOCTOR ---
-        final_response = llm_client.generate_combined_response(
-            model=model, 
-            model_type=model_type, 
-            user_input=user_input, 
-            matched_appointment=None, 
-            history_doctor_name=None,
-            routed_doctor_name=None
-        )
-        return _format_response_to_string(final_response)
+        prepared = _prepare_reply(clients, appointments_cache, user_input)
+        if prepared is None:
+            return EMERGENCY_MESSAGE
+        reply_args, routed_doctor_id = prepared
+        final_response = llm_client.generate_combined_response(clients.llm, clients.llm_type, **reply_args)
+
+    # The doctor's copy is the same response without the routing sentence, so no second LLM call is needed.
+    if routed_doctor_id:
+        _record_pending_approval_in_background(appointments_cache, routed_doctor_id, user_input, final_response)
+    return _format_response_to_string(final_response)
+
+def stream_chatbot_response(clients, patient_id, user_input, appointments_cache=None):
+    """
+    Same as get_chatbot_response, but yields the reply in text chunks as the LLM
+    generates it, so the user sees the first words without waiting for the whole reply.
+    The summary is streamed by its own call, since a JSON-mode reply can't be shown
+    until it is complete.
+    """
+    appointments_cache = appointments_cache or _appointments_cache_for(patient_id)
+    prepared = _prepare_reply(clients, appointments_cache, user_input)
+    if prepared is None:
+        yield EMERGENCY_MESSAGE
+        return
+    reply_args, routed_doctor_id = prepared
+
+    final_response = yield from llm_client.generate_combined_response_stream(clients.llm, clients.llm_type, **reply_args)
+    if routed_doctor_id:
+        _record_pending_approval_in_background(appointments_cache, routed_doctor_id, user_input, final_response)
+
+def _prefetch_next_turn(clients, appointments_cache):
+    """
+    Runs while the CLI waits for the user: refreshes the history if it went stale
+    and keeps the LLM connection open, so the next turn doesn't pay for either.
+    """
+    try:
+        appointments_cache.maybe_refresh()
+        llm_client.keep_alive(clients.llm, clients.llm_type)
+    except Exception as e:
+        print(f"Prefetch failed: {e}")
 
 def main():
     """
     Main function to run the chatbot in command-line mode.
     """
     try:
-        initialize_clients()
+        clients = initialize_clients()
     except Exception:
         return # Exit if initialization fails
 
@@ -124,7 +408,9 @@ def main():
         return
 
     print("\nFetching your past medical records...")
-    patient_appointments = firebase_client.get_patient_appointments_by_id(patient_id)
+    # Fetched and embedded once here; turns reuse it until it goes stale.
+    appointments_cache = AppointmentsCache(patient_id).maybe_refresh()
+    patient_appointments = appointments_cache.appointments
     
     patient_name = ""
     if not patient_appointments:
@@ -138,8 +424,14 @@ def main():
     print("You can describe your symptoms in any language. Type 'quit' to exit.")
 
     while True:
+        # Only prefetch if the user takes a while to type; otherwise the turn itself does it.
+        prefetch = threading.Timer(PREFETCH_DELAY, _prefetch_next_turn, args=(clients, appointments_cache))
+        prefetch.daemon = True
+        prefetch.start()
         user_input = input("\nYou: ")
+        prefetch.cancel()
         if user_input.lower() == 'quit':
+            flush_pending_writes()
             print("Goodbye! Stay healthy.")
             break
 
@@ -147,8 +439,12 @@ def main():
             continue
 
         print("Chatbot: Analyzing symptoms...")
-        response = get_chatbot_response(patient_id, user_input)
-        print(f"\nChatbot: {response}")
+        # Print the reply as it is generated rather than after the last token.
+        sys.stdout.write("\nChatbot: ")
+        for chunk in stream_chatbot_response(clients, patient_id, user_input, appointments_cache):
+            sys.stdout.write(chunk)
+            sys.stdout.flush()
+        print()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import llm_client
+
+
+def _fake_embed_appointments(appointments):
+    vectors = np.zeros((len(appointments), 4), dtype=np.float32)
+    for i, app in enumerate(appointments):
+        vectors[i, len(app["symptomsText"]) % 4] = 1.0
+    return vectors
+
+
+class AppointmentIndexTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(llm_client.embeddings, "embed_appointments", side_effect=_fake_embed_appointments)
+        self.embed = patch.start()
+        self.addCleanup(patch.stop)
+
+    def _appointment(self, medicine, symptoms="fever and cough"):
+        return {"doc_id": "a1", "symptomsText": symptoms, "appointmentDate": "2026-01-01",
+                "prescriptions": [{"name": medicine}]}
+
+    def test_refresh_uses_the_fresh_appointment_data(self):
+        index = llm_client.build_appointment_index([self._appointment("Panadol 500mg")])
+        refreshed = llm_client.build_appointment_index([self._appointment("Brufen 400mg")], index)
+        self.assertEqual(refreshed.candidates[0]["prescriptions"][0]["name"], "Brufen 400mg")
+        # The symptoms didn't change, so their embedding is reused.
+        self.assertEqual(self.embed.call_count, 1)
+
+    def test_edited_symptoms_are_embedded_again(self):
+        index = llm_client.build_appointment_index([self._appointment("Panadol 500mg")])
+        llm_client.build_appointment_index([self._appointment("Panadol 500mg", "sore throat")], index)
+        self.assertEqual(self.embed.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import llm_client
+
+
+class PrefilterRedFlagsTest(unittest.TestCase):
+    def test_clear_emergencies_are_flagged(self):
+        for text in ["I have chest pain", "My father can't breathe", "chest-pain since morning",
+                     "I think I am having a stroke", "sudden numbness in my face", "my child is choking",
+                     "no fever, but severe chest pain", "seene mein dard hai", "सीने में दर्द है"]:
+            with self.subTest(text=text):
+                self.assertIs(llm_client.prefilter_red_flags(text), True)
+
+    def test_negated_hits_go_to_the_llm(self):
+        for text in ["I have no chest pain, just a cough", "I don't have a severe headache",
+                     "not a heart attack I hope, just heartburn", "without any shortness of breath"]:
+            with self.subTest(text=text):
+                self.assertIsNone(llm_client.prefilter_red_flags(text))
+                self.assertEqual(llm_client.scan_red_flags(text), "weak")
+
+    def test_everyday_words_go_to_the_llm(self):
+        for text in ["I am confused about my medicine dosage", "my toes feel numb in the cold",
+                     "I had a stroke of luck", "heat stroke symptoms?", "I feel a bit disoriented after flying"]:
+            with self.subTest(text=text):
+                self.assertIsNone(llm_client.prefilter_red_flags(text))
+
+    def test_phrases_only_match_whole_words(self):
+        self.assertIsNone(llm_client.prefilter_red_flags("I had heatstroke last summer, now a mild cough"))
+
+    def test_small_talk_skips_the_llm(self):
+        for text in ["hello", "Thanks!", "assalam o alaikum", "ok bye"]:
+            with self.subTest(text=text):
+                self.assertIs(llm_client.prefilter_red_flags(text), False)
+
+    def test_other_symptoms_go_to_the_llm(self):
+        self.assertIsNone(llm_client.prefilter_red_flags("I have a headache"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+import main
+
+
+class RespondInOneCallTest(unittest.TestCase):
+    def setUp(self):
+        self.clients = main.Clients(llm=object(), llm_type="openai")
+        self.cache = SimpleNamespace(patient_id="p1", maybe_refresh=lambda: SimpleNamespace(index=None))
+        patch = mock.patch.object(main.llm_client, "find_best_match", return_value=None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def _respond(self, user_input, red_flag):
+        analysis = {"red_flag": red_flag, "specialty": None, "summary": "Take rest."}
+        with mock.patch.object(main.llm_client, "analyze_turn", return_value=analysis) as analyze:
+            return main._respond_in_one_call(self.clients, self.cache, user_input), analyze
+
+    def test_strong_hit_ends_the_turn_locally(self):
+        result, analyze = self._respond("I have chest pain", red_flag=False)
+        self.assertIsNone(result)
+        analyze.assert_not_called()
+
+    def test_model_decides_negated_and_weak_hits(self):
+        for text in ["I have no chest pain, just a cough", "I am confused about my medicine dosage"]:
+            with self.subTest(text=text):
+                result, analyze = self._respond(text, red_flag=False)
+                analyze.assert_called_once()
+                self.assertIsNotNone(result)
+                self.assertEqual(result[0].summary, "Take rest.")
+
+    def test_model_red_flag_is_honoured(self):
+        result, _ = self._respond("my toes feel numb", red_flag=True)
+        self.assertIsNone(result)
+
+    def test_unparsable_reply_falls_back_without_redoing_the_turn(self):
+        appointment = {"doc_id": "a1", "staffId": "s1", "symptomsText": "fever"}
+        response = object()
+        with mock.patch.object(main.llm_client, "find_best_match", return_value=appointment), \
+             mock.patch.object(main.firebase_client, "get_doctor_name", return_value="Ali") as get_name, \
+             mock.patch.object(main.embeddings, "embed", return_value=[[1.0]]), \
+             mock.patch.object(main.llm_client, "analyze_turn", return_value=None) as analyze, \
+             mock.patch.object(main.llm_client, "check_for_red_flags", return_value=False), \
+             mock.patch.object(main.llm_client, "get_specialty_for_symptoms", return_value="ENT"), \
+             mock.patch.object(main.firebase_client, "find_doctor_by_specialty", return_value=("d1", "Sara")), \
+             mock.patch.object(main.llm_client, "generate_combined_response", return_value=response) as generate:
+            result = main._respond_in_one_call(self.clients, self.cache, "fever again")
+        self.assertEqual(result, (response, "d1"))
+        analyze.assert_called_once()
+        get_name.assert_called_once()
+        self.assertEqual(generate.call_args.args[4:7], (appointment, "Ali", "Sara"))
+
+
+if __name__ == '__main__':
+    unittest.main()